@@ -0,0 +1,107 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+Compiled enumeration kernel for heredity.py, used instead of the Numba
+kernel when built, since it needs no JIT compilation on each run.
+Configurations are split across threads with OpenMP.
+
+Build with `python setup.py build_ext --inplace`.
+"""
+
+cimport openmp
+from cython.parallel cimport prange, threadid
+from libc.math cimport exp
+
+import numpy as np
+
+# Increased whenever joint_kernel's arguments change, so that heredity.py
+# can tell a stale build from a current one
+KERNEL_VERSION = 2
+
+# Most people a gene configuration can be decoded for
+cdef enum:
+    MAX_PEOPLE = 32
+
+
+def joint_kernel(const int[:] mother_idx, const int[:] father_idx,
+                 const signed char[:] trait_known,
+                 const double[:, :, :] log_parent_table,
+                 const double[:] log_gene_prior,
+                 const double[:, :] log_trait_probs,
+                 const double[:, :] trait_probs,
+                 double log_bound):
+    """
+    Enumerate all 3^n gene configurations as base-3 integers, in parallel,
+    summing out traits in closed form as `heredity._joint_kernel` does.
+    Return `gene_accum` and `trait_accum` as for `heredity.to_probabilities`.
+    """
+    cdef Py_ssize_t n = mother_idx.shape[0]
+    if n > MAX_PEOPLE:
+        raise ValueError(f"cannot enumerate more than {MAX_PEOPLE} people")
+
+    # One set of accumulators and one scratch row of gene counts per
+    # thread, so threads never write to the same memory. OpenMP picks the
+    # number of threads, respecting OMP_NUM_THREADS and CPU affinity
+    cdef int n_threads = openmp.omp_get_max_threads()
+    gene_accum_array = np.zeros((n_threads, n, 3))
+    trait_accum_array = np.zeros((n_threads, n, 2))
+    cdef double[:, :, :] gene_accum = gene_accum_array
+    cdef double[:, :, :] trait_accum = trait_accum_array
+    cdef int[:, :] scratch = np.empty((n_threads, MAX_PEOPLE), dtype=np.intc)
+
+    cdef long long config, n_configs = 1
+    cdef Py_ssize_t i
+    for i in range(n):
+        n_configs *= 3
+
+    for config in prange(n_configs, nogil=True, schedule="static", num_threads=n_threads):
+        add_config(
+            config, threadid(), n, mother_idx, father_idx, trait_known,
+            log_parent_table, log_gene_prior, log_trait_probs, trait_probs,
+            log_bound, scratch, gene_accum, trait_accum
+        )
+
+    return gene_accum_array.sum(axis=0), trait_accum_array.sum(axis=0)
+
+
+cdef void add_config(long long config, int thread, Py_ssize_t n,
+                     const int[:] mother_idx, const int[:] father_idx,
+                     const signed char[:] trait_known,
+                     const double[:, :, :] log_parent_table,
+                     const double[:] log_gene_prior,
+                     const double[:, :] log_trait_probs,
+                     const double[:, :] trait_probs,
+                     double log_bound, int[:, :] scratch,
+                     double[:, :, :] gene_accum,
+                     double[:, :, :] trait_accum) noexcept nogil:
+    """
+    Add one configuration's probability to `thread`'s accumulators.
+    """
+    cdef int *genes = &scratch[thread, 0]
+    cdef long long rest = config
+    cdef Py_ssize_t i
+    cdef double logp, p
+
+    # Decode person i's gene count from the i-th base-3 digit
+    for i in range(n):
+        genes[i] = rest % 3
+        rest = rest // 3
+
+    # Sum log-probabilities, and shift by `log_bound` (see
+    # `heredity.log_probability_bound`) before leaving log-space
+    logp = -log_bound
+    for i in range(n):
+        if mother_idx[i] == -1:
+            logp += log_gene_prior[genes[i]]
+        else:
+            logp += log_parent_table[genes[i], genes[mother_idx[i]], genes[father_idx[i]]]
+        if trait_known[i] != -1:
+            logp += log_trait_probs[genes[i], trait_known[i]]
+    p = exp(logp)
+
+    for i in range(n):
+        gene_accum[thread, i, genes[i]] += p
+        if trait_known[i] == -1:
+            trait_accum[thread, i, 0] += p * trait_probs[genes[i], 0]
+            trait_accum[thread, i, 1] += p * trait_probs[genes[i], 1]
+        else:
+            trait_accum[thread, i, trait_known[i]] += p
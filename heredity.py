@@ -1,8 +1,34 @@
 import csv
-import itertools
+import functools
+import importlib.util
+import multiprocessing
+import pkgutil
 import sys
 import random
 import math
+import warnings
+
+import numpy as np
+
+# Version of `_heredity.joint_kernel` called below; an extension built
+# from an older _heredity.pyx is ignored, with a warning, until rebuilt
+HEREDITY_KERNEL_VERSION = 2
+
+try:
+    import _heredity
+except ImportError:
+    _heredity = None
+if _heredity is not None and getattr(_heredity, "KERNEL_VERSION", None) != HEREDITY_KERNEL_VERSION:
+    warnings.warn(
+        "Ignoring the Cython kernel, built from an older _heredity.pyx; "
+        "rebuild it with `python setup.py build_ext --inplace`"
+    )
+    _heredity = None
+
+# Numba and JAX are slow to import, so neither is imported until a
+# family needs it: Numba by `import_numba`, into this global, and JAX by
+# `import_jax`
+numba = None
 
 
 PROBS = {
@@ -39,62 +65,689 @@ PROBS = {
     "mutation": 0.01
 }
 
+# Unconditional probability of each gene count, indexed by gene count
+GENE_PRIOR = np.array([PROBS["gene"][genes] for genes in range(3)])
+
+# Probability of each trait given gene count, indexed by [genes, trait]
+TRAIT_PROBS = np.array([
+    [PROBS["trait"][genes][False], PROBS["trait"][genes][True]]
+    for genes in range(3)
+])
+
+# Probability a parent passes the gene on, indexed by their gene count
+TRANSMISSION = np.array([PROBS["mutation"], 0.5, 1 - PROBS["mutation"]])
+
+# Probability of a child's gene count,
+# indexed by [genes, mother_genes, father_genes]
+PARENT_TABLE = np.stack([
+    np.outer(1 - TRANSMISSION, 1 - TRANSMISSION),
+    np.outer(TRANSMISSION, 1 - TRANSMISSION) + np.outer(1 - TRANSMISSION, TRANSMISSION),
+    np.outer(TRANSMISSION, TRANSMISSION)
+])
+
+# Joint probabilities are computed as sums of these. A probability of 0,
+# e.g. with no mutation, is -inf, which every exact path handles; Gibbs
+# sampling refuses to run then (see `gibbs`)
+with np.errstate(divide="ignore"):
+    LOG_GENE_PRIOR = np.log(GENE_PRIOR)
+    LOG_TRAIT_PROBS = np.log(TRAIT_PROBS)
+    LOG_PARENT_TABLE = np.log(PARENT_TABLE)
+
+# Largest family enumerated with NumPy when a compiled kernel could run
+# instead, and most memory the NumPy batch may use, in bytes
+BATCH_MAX_PEOPLE = 12
+MAX_BATCH_BYTES = 2 ** 28
+
+# Smallest family worth compiling the batch into one JAX kernel for, on
+# a GPU, and most GPU memory that batch may use, in bytes; on CPU,
+# compilation costs more than NumPy takes to run the batch
+JAX_MIN_PEOPLE = 10
+MAX_JAX_BYTES = 2 ** 32
+
+# Prefixes of the plugins that let JAX run on a GPU, e.g. jax_cuda12_plugin,
+# looked for before importing JAX, which CPU-only installs don't need
+JAX_GPU_PLUGIN_PREFIXES = ("jax_cuda", "jax_rocm")
+
+# Number of trait sets handed to a worker process at a time
+LOOP_CHUNK_SIZE = 256
+
+# Largest family enumerated exactly unless --method=enum is given;
+# larger families are sampled with Gibbs sampling instead
+ENUM_MAX_PEOPLE = 16
+
+# Largest family enumerated by default when the Cython kernel is built,
+# about half a minute on one core
+CYTHON_ENUM_MAX_PEOPLE = 18
+
+# Largest family that can be enumerated at all: the kernels count
+# 3^N configurations in 64-bit integers, and the Cython kernel decodes
+# each configuration into a fixed array of this many people
+ENUM_LIMIT_PEOPLE = 32
+
+# Number of independent Gibbs sampling chains, and sweeps over
+# everyone's gene count per chain, the first GIBBS_BURN_IN discarded
+GIBBS_CHAINS = 8
+GIBBS_ITERATIONS = 20000
+GIBBS_BURN_IN = 1000
+
+# Largest standard error of any estimated probability, from the spread
+# of the chains' estimates, before the estimates are reported as
+# unreliable. Families with one mode stay well under it, at 20000 sweeps
+GIBBS_TOLERANCE = 0.02
+
 
 def main():
 
     # Check for proper usage
-    if len(sys.argv) != 2:
-        sys.exit("Usage: python heredity.py data.csv")
+    usage = "Usage: python heredity.py data.csv [--method=enum|gibbs]"
+    if len(sys.argv) not in (2, 3):
+        sys.exit(usage)
+    method = None
+    if len(sys.argv) == 3:
+        if not sys.argv[2].startswith("--method="):
+            sys.exit(usage)
+        method = sys.argv[2][len("--method="):]
+        if method not in ("enum", "gibbs"):
+            sys.exit(usage)
     people = load_data(sys.argv[1])
+    order, mother_idx, father_idx, trait_known = index_people(people)
+
+    # Enumeration is exact but exponential, so sample for large families
+    if method is None:
+        enum_max = CYTHON_ENUM_MAX_PEOPLE if _heredity is not None else ENUM_MAX_PEOPLE
+        method = "enum" if len(order) <= enum_max else "gibbs"
+    if method == "enum":
+        if len(order) > ENUM_LIMIT_PEOPLE:
+            sys.exit(f"Cannot enumerate more than {ENUM_LIMIT_PEOPLE} people, use --method=gibbs")
+        try:
+            gene_accum, trait_accum = enum_probabilities(mother_idx, father_idx, trait_known)
+        except ValueError as error:
+            sys.exit(str(error))
+        ranges = None
+    elif not PARENT_TABLE.all():
+        sys.exit("Gibbs sampling requires a nonzero mutation probability, use --method=enum")
+    elif numba_installed():
+        gene_accum, trait_accum, ranges, error = gibbs_estimates(
+            mother_idx, father_idx, trait_known
+        )
+    else:
+        sys.exit("Gibbs sampling requires Numba (pip install numba)")
+
+    # Ensure probabilities sum to 1
+    normalize(gene_accum, trait_accum)
+    probabilities = to_probabilities(gene_accum, trait_accum)
+
+    # Print results, with the range of each chain's estimate if sampled
+    if ranges is not None:
+        print(f"Estimated with Gibbs sampling, {GIBBS_CHAINS} chains of "
+              f"{GIBBS_ITERATIONS} sweeps; ranges across chains in brackets")
+    for i, (person, distributions) in enumerate(zip(order, probabilities)):
+        print(f"{person}:")
+        for field in distributions:
+            print(f"  {field.capitalize()}:")
+            for value in distributions[field]:
+                p = distributions[field][value]
+                if ranges is None:
+                    print(f"    {value}: {p:.4f}")
+                else:
+                    low, high = ranges[0][i][field][value], ranges[1][i][field][value]
+                    print(f"    {value}: {p:.4f} [{low:.4f}, {high:.4f}]")
+
+    # Chains that disagree far more than sampling noise explains have
+    # most likely each stuck to a different mode, such as which parent
+    # passed the gene on
+    if ranges is not None and error > GIBBS_TOLERANCE:
+        print(f"Warning: chains disagree, with a standard error of up to {error:.4f}, "
+              "so these estimates are unreliable; use --method=enum if the family "
+              "is small enough", file=sys.stderr)
+
+
+def enum_probabilities(mother_idx, father_idx, trait_known):
+    """
+    Compute unnormalized probabilities exactly, by enumerating every
+    configuration in whichever way suits the size of the family.
+    Return `gene_accum` and `trait_accum` as for `to_probabilities`.
+
+    Raise ValueError if not even one gene row of the NumPy batch fits in
+    MAX_BATCH_BYTES and no compiled kernel is available, since only the
+    reference `loop_probabilities` would be left, which would never finish.
+    """
+
+    n = len(mother_idx)
+    free = int(np.count_nonzero(trait_known == -1))
+
+    # Peak memory of the batch per gene row: its int8 gene counts, plus a
+    # few float64 arrays with an entry per trait row
+    row_bytes = n + 3 * 8 * 2 ** free
+    batch_bytes = 3 ** n * row_bytes
+    batch_fits = batch_bytes <= MAX_BATCH_BYTES
+
+    # A GPU runs the whole batch fastest, wherever it fits in memory
+    if n >= JAX_MIN_PEOPLE and batch_bytes <= MAX_JAX_BYTES and jax_has_gpu():
+        return jax_probabilities(mother_idx, father_idx, trait_known)
+
+    # The Cython kernel runs in parallel like the Numba one, and needs no JIT compile
+    if _heredity is not None:
+        return cython_probabilities(mother_idx, father_idx, trait_known)
+
+    # For small families, NumPy finishes before Numba could compile
+    if n <= BATCH_MAX_PEOPLE and batch_fits:
+        return batch_probabilities(mother_idx, father_idx, trait_known)
+    if numba_installed():
+        return kernel_probabilities(mother_idx, father_idx, trait_known)
 
-    # Keep track of gene and trait probabilities for each person
-    probabilities = {
-        person: {
+    # Otherwise NumPy is still far faster than the loop, even a slice of
+    # gene rows at a time, as long as one gene row fits
+    if row_bytes <= MAX_BATCH_BYTES:
+        return batch_probabilities(mother_idx, father_idx, trait_known)
+    raise ValueError(
+        "Enumerating this family requires Numba (pip install numba) or the "
+        "Cython kernel (python setup.py build_ext --inplace)"
+    )
+
+
+def to_probabilities(gene_accum, trait_accum):
+    """
+    Convert `gene_accum` of shape (N, 3), indexed by gene count, and
+    `trait_accum` of shape (N, 2), indexed by trait, into a gene and trait
+    distribution for each person.
+    """
+    return [
+        {
             "gene": {
-                2: 0,
-                1: 0,
-                0: 0
+                2: gene_row[2],
+                1: gene_row[1],
+                0: gene_row[0]
             },
             "trait": {
-                True: 0,
-                False: 0
+                True: trait_row[1],
+                False: trait_row[0]
             }
         }
-        for person in people
-    }
-
-    # Loop over all sets of people who might have the trait
-    names = set(people)
-    for have_trait in powerset(names):
-
-        # Check if current set of people violates known information
-        fails_evidence = any(
-            (people[person]["trait"] is not None and
-             people[person]["trait"] != (person in have_trait))
-            for person in names
+        for gene_row, trait_row in zip(gene_accum.tolist(), trait_accum.tolist())
+    ]
+
+
+def loop_probabilities(mother_idx, father_idx, trait_known):
+    """
+    Compute unnormalized probabilities by looping over one configuration
+    at a time, directly from the definition of the joint probability.
+    This is the reference implementation the other paths are tested
+    against, not a fallback: `enum_probabilities` never calls it, since it
+    is far too slow for any family the other paths can't handle. Sets of
+    people with one copy of the gene are split into chunks across
+    processes, each holding only the sets of people who might have the
+    trait, one per assignment of the unknown traits.
+    Return `gene_accum` and `trait_accum` as for `to_probabilities`.
+    """
+    n = len(mother_idx)
+
+    # Plain ints index far faster than NumPy scalars in the loop below
+    mothers = tuple(mother_idx.tolist())
+    fathers = tuple(father_idx.tolist())
+
+    # Fix the trait of everyone whose trait is known, and only vary the rest
+    known_mask = sum(1 << i for i in range(n) if trait_known[i] != -1)
+    known_value = sum(1 << i for i in range(n) if trait_known[i] == 1)
+
+    # Split the sets of people with one copy of the gene into chunks,
+    # generated as the workers ask for them
+    one_gene_masks = powerset_bits(n)
+    n_chunks = -(-len(one_gene_masks) // LOOP_CHUNK_SIZE)
+    chunks = (
+        one_gene_masks[i:i + LOOP_CHUNK_SIZE]
+        for i in range(0, len(one_gene_masks), LOOP_CHUNK_SIZE)
+    )
+
+    # Start fresh worker processes rather than forking this one, which
+    # hangs at exit if a Numba kernel has already started threads here,
+    # and no more of them than there are chunks to run
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        min(context.cpu_count(), n_chunks),
+        initializer=_init_loop_worker,
+        initargs=(mothers, fathers, known_mask, known_value)
+    ) as pool:
+        gene_parts, trait_parts = zip(*pool.imap_unordered(_loop_worker, chunks))
+
+    return functools.reduce(np.add, gene_parts), functools.reduce(np.add, trait_parts)
+
+
+# Number of people, sets of people who might have the trait, and gene and
+# trait probability functions, shared by every task a worker runs
+_worker_n = None
+_worker_trait_masks = None
+_worker_gene_probability = None
+_worker_trait_probability = None
+
+
+def _init_loop_worker(mothers, fathers, known_mask, known_value):
+    """
+    Set up the sets of people who might have the trait, and the gene and
+    trait probability functions, once per worker process, so the family
+    isn't pickled along with every task. The sets are built here from
+    `known_mask`, the people whose trait is known, and `known_value`,
+    those known to have it, rather than pickled.
+    """
+    global _worker_n, _worker_trait_masks
+    global _worker_gene_probability, _worker_trait_probability
+    _worker_n = len(mothers)
+    free = ((1 << _worker_n) - 1) ^ known_mask
+    _worker_trait_masks = [free_trait | known_value for free_trait in submasks(free)]
+    _worker_gene_probability = functools.partial(gene_joint_probability, mothers, fathers)
+    _worker_trait_probability = functools.partial(trait_joint_probability, _worker_n)
+
+
+def _loop_worker(one_gene_masks):
+    """
+    Sum joint probabilities over every configuration in which the set of
+    people with one copy of the gene is in `one_gene_masks`.
+    Return `gene_accum` and `trait_accum` as for `to_probabilities`.
+    """
+    n = _worker_n
+    trait_masks = _worker_trait_masks
+    gene_probability = _worker_gene_probability
+    trait_probability = _worker_trait_probability
+    gene_accum = np.zeros((n, 3))
+    trait_accum = np.zeros((n, 2))
+
+    everyone = (1 << n) - 1
+    for one_gene in one_gene_masks:
+
+        # Loop over all sets of people without one copy who have two
+        for two_genes in submasks(everyone ^ one_gene):
+
+            # The gene factor is the same for every set with the trait,
+            # and if it is zero, so is every joint probability below
+            gene_p = gene_probability(one_gene, two_genes)
+            if gene_p == 0.0:
+                continue
+
+            # Loop over all sets of people who might have the trait
+            for have_trait in trait_masks:
+
+                # Update probabilities with new joint probability
+                p = gene_p * trait_probability(one_gene, two_genes, have_trait)
+                update(gene_accum, trait_accum, one_gene, two_genes, have_trait, p)
+
+    return gene_accum, trait_accum
+
+
+def batch_probabilities(mother_idx, father_idx, trait_known):
+    """
+    Compute unnormalized probabilities by evaluating the joint probability
+    of every (gene, trait) configuration in NumPy passes, each over as
+    many gene rows as fit in MAX_BATCH_BYTES, usually all of them.
+    Return `gene_accum` and `trait_accum` as for `to_probabilities`.
+    """
+    n = len(mother_idx)
+    free = int(np.count_nonzero(trait_known == -1))
+    n_rows = 3 ** n
+    slice_rows = max(1, MAX_BATCH_BYTES // (n + 3 * 8 * 2 ** free))
+
+    gene_accum = np.zeros((n, 3))
+    trait_accum = np.zeros((n, 2))
+    shift = -np.inf
+    for start in range(0, n_rows, slice_rows):
+        gene_grid, trait_grid, logp_all = batch_joint_log_probabilities(
+            mother_idx, father_idx, trait_known, start, min(start + slice_rows, n_rows)
         )
-        if fails_evidence:
+
+        # Scale by the largest probability so far before leaving log-space,
+        # as in logsumexp, so tiny probabilities don't all underflow to
+        # zero; earlier slices are rescaled whenever it grows
+        slice_max = logp_all.max()
+        if slice_max == -np.inf:
             continue
+        if slice_max > shift:
+            scale = np.exp(shift - slice_max)
+            gene_accum *= scale
+            trait_accum *= scale
+            shift = slice_max
+        p_all = np.exp(logp_all - shift)
 
-        # Loop over all sets of people who might have the gene
-        for one_gene in powerset(names):
-            for two_genes in powerset(names - one_gene):
+        # Marginalize over traits for the gene distributions, and vice versa
+        p_gene = p_all.sum(axis=1)
+        p_trait = p_all.sum(axis=0)
 
-                # Update probabilities with new joint probability
-                p = joint_probability(people, one_gene, two_genes, have_trait)
-                update(probabilities, one_gene, two_genes, have_trait, p)
+        # Scatter-add each row's probability into each person's accumulators
+        for i in range(n):
+            np.add.at(gene_accum[i], gene_grid[:, i], p_gene)
+            np.add.at(trait_accum[i], trait_grid[:, i], p_trait)
 
-    # Ensure probabilities sum to 1
-    normalize(probabilities)
+    return gene_accum, trait_accum
 
-    # Print results
-    for person in people:
-        print(f"{person}:")
-        for field in probabilities[person]:
-            print(f"  {field.capitalize()}:")
-            for value in probabilities[person][field]:
-                p = probabilities[person][field][value]
-                print(f"    {value}: {p:.4f}")
+
+def jax_has_gpu():
+    """
+    Return whether JAX is installed and has a GPU to run on. JAX is only
+    imported when a CUDA or ROCm plugin for it is installed.
+    """
+    if not any(
+        module.name.startswith(JAX_GPU_PLUGIN_PREFIXES) and module.name.endswith("_plugin")
+        for module in pkgutil.iter_modules()
+    ):
+        return False
+    try:
+        jax = import_jax()
+    except ImportError:
+        return False
+    return jax.default_backend() != "cpu"
+
+
+@functools.cache
+def import_jax():
+    """
+    Import JAX and return it. 64-bit floats are enabled for all of JAX
+    once it is imported, so `jax_probabilities` computes in double
+    precision.
+    """
+    import jax
+    jax.config.update("jax_enable_x64", True)
+    return jax
+
+
+def jax_probabilities(mother_idx, father_idx, trait_known):
+    """
+    Compute unnormalized probabilities like `batch_probabilities`, but as
+    a single JIT-compiled JAX computation, which runs on a GPU if present.
+    Return `gene_accum` and `trait_accum` as for `to_probabilities`.
+    """
+    jax = import_jax()
+    import jax.numpy as jnp
+
+    n = len(mother_idx)
+    gene_grid, trait_grid = config_grids(trait_known)
+    factor = log_gene_factor_table(mother_idx)
+
+    @jax.jit
+    def accumulate(factor, log_trait_probs, gene_grid, trait_grid):
+
+        # Sum the terms one person at a time, as in
+        # `batch_joint_log_probabilities`, which XLA fuses into one pass
+        gene_logp = jnp.zeros(len(gene_grid))
+        for i in range(n):
+            gene_logp += factor[i][
+                gene_grid[:, i], gene_grid[:, mother_idx[i]], gene_grid[:, father_idx[i]]
+            ]
+        logp_all = jnp.broadcast_to(gene_logp[:, None], (len(gene_grid), len(trait_grid)))
+        for i in range(n):
+            logp_all += log_trait_probs[gene_grid[:, i, None], trait_grid[None, :, i]]
+        p_all = jnp.exp(logp_all - logp_all.max())
+
+        # Marginalize and scatter-add as in `batch_probabilities`
+        p_gene = p_all.sum(axis=1)
+        p_trait = p_all.sum(axis=0)
+        gene_accum = jnp.zeros((n, 3))
+        trait_accum = jnp.zeros((n, 2))
+        for i in range(n):
+            gene_accum = gene_accum.at[i, gene_grid[:, i]].add(p_gene)
+            trait_accum = trait_accum.at[i, trait_grid[:, i]].add(p_trait)
+        return gene_accum, trait_accum
+
+    gene_accum, trait_accum = accumulate(factor, LOG_TRAIT_PROBS, gene_grid, trait_grid)
+    return np.array(gene_accum), np.array(trait_accum)
+
+
+def kernel_probabilities(mother_idx, father_idx, trait_known):
+    """
+    Compute unnormalized probabilities with the compiled `_joint_kernel`,
+    for families too large to enumerate in one batch.
+    Return `gene_accum` and `trait_accum` as for `to_probabilities`.
+    """
+    kernel = compiled_joint_kernel()
+    n_chunks = numba.get_num_threads()
+    return kernel(
+        mother_idx, father_idx, trait_known, LOG_PARENT_TABLE,
+        LOG_GENE_PRIOR, LOG_TRAIT_PROBS, TRAIT_PROBS,
+        log_probability_bound(mother_idx, trait_known), len(mother_idx),
+        n_chunks, np.empty((n_chunks, len(mother_idx)), dtype=np.int8)
+    )
+
+
+def cython_probabilities(mother_idx, father_idx, trait_known):
+    """
+    Compute unnormalized probabilities with the Cython kernel,
+    `_heredity.joint_kernel`, which must be built.
+    Return `gene_accum` and `trait_accum` as for `to_probabilities`.
+    """
+    return _heredity.joint_kernel(
+        mother_idx, father_idx, trait_known, LOG_PARENT_TABLE,
+        LOG_GENE_PRIOR, LOG_TRAIT_PROBS, TRAIT_PROBS,
+        log_probability_bound(mother_idx, trait_known)
+    )
+
+
+def log_probability_bound(mother_idx, trait_known):
+    """
+    Return an upper bound on the log joint probability of any gene
+    configuration, with unknown traits summed out: the sum of each
+    person's largest possible factor. The compiled kernels subtract it
+    before leaving log-space, as in logsumexp, so the likeliest
+    configurations can't underflow to zero however deep the pedigree.
+    """
+    gene_bound = np.where(mother_idx == -1, LOG_GENE_PRIOR.max(), LOG_PARENT_TABLE.max())
+    trait_bound = np.where(
+        trait_known == -1, 0.0, LOG_TRAIT_PROBS[:, np.maximum(trait_known, 0)].max(axis=0)
+    )
+    return float(gene_bound.sum() + trait_bound.sum())
+
+
+def _joint_kernel(mother_idx, father_idx, trait_known, log_parent_table,
+                  log_gene_prior, log_trait_probs, trait_probs, log_bound, n,
+                  n_chunks, scratch):
+    """
+    Enumerate all 3^n gene configurations as base-3 integers, in parallel,
+    as `n_chunks` contiguous ranges of configurations. Each configuration
+    is decoded into its chunk's row of `scratch`, of shape (n_chunks, n),
+    overwritten for every configuration rather than allocated for each.
+
+    Traits are summed out in closed form: a known trait contributes its
+    likelihood to the joint probability, and an unknown trait splits each
+    configuration's probability between True and False.
+    """
+    # One set of accumulators per chunk, reduced at the end
+    n_configs = 3 ** n
+    gene_accum = np.zeros((n_chunks, n, 3))
+    trait_accum = np.zeros((n_chunks, n, 2))
+
+    # The first `extra` chunks take one configuration more than the rest;
+    # bounds are computed without `chunk * n_configs`, which can overflow
+    base, extra = divmod(n_configs, n_chunks)
+
+    for chunk in numba.prange(n_chunks):
+        genes = scratch[chunk]
+        start = chunk * base + min(chunk, extra)
+        stop = start + base + (1 if chunk < extra else 0)
+        for config in range(start, stop):
+
+            # Decode person i's gene count from the i-th base-3 digit
+            rest = config
+            for i in range(n):
+                genes[i] = rest % 3
+                rest //= 3
+
+            # Sum log-probabilities, and shift by the bound before leaving
+            # log-space so deep pedigrees don't underflow
+            logp = -log_bound
+            for i in range(n):
+                if mother_idx[i] == -1:
+                    logp += log_gene_prior[genes[i]]
+                else:
+                    logp += log_parent_table[genes[i], genes[mother_idx[i]], genes[father_idx[i]]]
+                if trait_known[i] != -1:
+                    logp += log_trait_probs[genes[i], trait_known[i]]
+            p = np.exp(logp)
+
+            for i in range(n):
+                gene_accum[chunk, i, genes[i]] += p
+                if trait_known[i] == -1:
+                    trait_accum[chunk, i, 0] += p * trait_probs[genes[i], 0]
+                    trait_accum[chunk, i, 1] += p * trait_probs[genes[i], 1]
+                else:
+                    trait_accum[chunk, i, trait_known[i]] += p
+
+    return gene_accum.sum(axis=0), trait_accum.sum(axis=0)
+
+
+@functools.cache
+def compiled_joint_kernel():
+    """
+    Return `_joint_kernel` compiled with Numba.
+    """
+
+    # All fast-math flags except those assuming no infinities or NaNs,
+    # since the log tables hold -inf when the mutation probability is 0
+    return import_numba().njit(
+        parallel=True, cache=True, fastmath={"nsz", "arcp", "contract", "reassoc"}
+    )(_joint_kernel)
+
+
+def gibbs_estimates(mother_idx, father_idx, trait_known):
+    """
+    Estimate probabilities with `gibbs`, as the mean of every chain's
+    estimate. Return `gene_accum` and `trait_accum` as for
+    `to_probabilities`; the lowest and highest of the chains' estimates,
+    each converted by `to_probabilities`; and the largest standard error
+    of the mean of any probability, from the chains' standard deviation.
+    """
+    chain_genes, chain_traits = gibbs(mother_idx, father_idx, trait_known, GIBBS_ITERATIONS)
+    for gene_accum, trait_accum in zip(chain_genes, chain_traits):
+        normalize(gene_accum, trait_accum)
+    ranges = (
+        to_probabilities(chain_genes.min(axis=0), chain_traits.min(axis=0)),
+        to_probabilities(chain_genes.max(axis=0), chain_traits.max(axis=0))
+    )
+    n_chains = len(chain_genes)
+    error = max(
+        accum.std(axis=0, ddof=1).max(initial=0.0) / math.sqrt(n_chains)
+        for accum in (chain_genes, chain_traits)
+    )
+    return chain_genes.mean(axis=0), chain_traits.mean(axis=0), ranges, error
+
+
+def gibbs(mother_idx, father_idx, trait_known, n_iter, seed=0):
+    """
+    Estimate unnormalized probabilities by Gibbs sampling gene counts,
+    with GIBBS_CHAINS independent chains of `n_iter` sweeps run in parallel.
+    Return `gene_accum` and `trait_accum` for each chain, as for
+    `to_probabilities` but with a leading axis indexed by chain.
+
+    Raise ValueError if any child gene count is impossible given their
+    parents', as with no mutation: single-site updates then can't move
+    between every possible configuration, and the estimates are wrong.
+    """
+    if not PARENT_TABLE.all():
+        raise ValueError("Gibbs sampling requires a nonzero mutation probability")
+    child_start, child_idx = children(mother_idx, father_idx)
+    return compiled_gibbs_kernel()(
+        mother_idx, father_idx, trait_known, child_start, child_idx,
+        LOG_PARENT_TABLE, LOG_GENE_PRIOR, LOG_TRAIT_PROBS, TRAIT_PROBS,
+        GIBBS_CHAINS, n_iter, GIBBS_BURN_IN, seed
+    )
+
+
+def children(mother_idx, father_idx):
+    """
+    Return the children of every person in compressed form: the children
+    of person i are `child_idx[child_start[i]:child_start[i + 1]]`.
+    """
+    n = len(mother_idx)
+    parents = np.concatenate([mother_idx, father_idx])
+    kids = np.concatenate([np.arange(n), np.arange(n)]).astype(np.int32)
+    has_parent = parents != -1
+    parents = parents[has_parent]
+    kids = kids[has_parent]
+
+    by_parent = np.argsort(parents, kind="stable")
+    child_start = np.searchsorted(parents[by_parent], np.arange(n + 1)).astype(np.int32)
+    return child_start, kids[by_parent]
+
+
+def _gibbs_kernel(mother_idx, father_idx, trait_known, child_start, child_idx,
+                  log_parent_table, log_gene_prior, log_trait_probs, trait_probs,
+                  n_chains, n_iter, burn_in, seed):
+    """
+    Run `n_chains` Gibbs chains in parallel. Each sweep resamples every
+    person's gene count from its distribution given everyone else's:
+    from their parents (or the prior), their own known trait, and their
+    children. That distribution itself, rather than the sample drawn from
+    it, is accumulated after burn-in, which gives lower-variance estimates.
+    """
+    n = len(mother_idx)
+    gene_accum = np.zeros((n_chains, n, 3))
+    trait_accum = np.zeros((n_chains, n, 2))
+
+    for chain in numba.prange(n_chains):
+        np.random.seed(seed + chain)
+
+        # Start every chain from a different random configuration, so that
+        # chains which can't leave a mode mostly settle in different ones
+        # and disagree, rather than all agreeing on the same wrong answer
+        genes = np.empty(n, dtype=np.int8)
+        for i in range(n):
+            genes[i] = np.random.randint(0, 3)
+
+        logw = np.empty(3)
+        for sweep in range(n_iter):
+            for i in range(n):
+
+                # Log-probability of each gene count for person i
+                for g in range(3):
+                    if mother_idx[i] == -1:
+                        logw[g] = log_gene_prior[g]
+                    else:
+                        logw[g] = log_parent_table[g, genes[mother_idx[i]], genes[father_idx[i]]]
+                    if trait_known[i] != -1:
+                        logw[g] += log_trait_probs[g, trait_known[i]]
+                    for k in range(child_start[i], child_start[i + 1]):
+                        child = child_idx[k]
+                        mother_genes = g if mother_idx[child] == i else genes[mother_idx[child]]
+                        father_genes = g if father_idx[child] == i else genes[father_idx[child]]
+                        logw[g] += log_parent_table[genes[child], mother_genes, father_genes]
+
+                w = np.exp(logw - logw.max())
+                w /= w.sum()
+
+                # Sample person i's new gene count
+                u = np.random.random()
+                genes[i] = 0 if u < w[0] else 1 if u < w[0] + w[1] else 2
+
+                if sweep >= burn_in:
+                    for g in range(3):
+                        gene_accum[chain, i, g] += w[g]
+                        if trait_known[i] == -1:
+                            trait_accum[chain, i, 0] += w[g] * trait_probs[g, 0]
+                            trait_accum[chain, i, 1] += w[g] * trait_probs[g, 1]
+                    if trait_known[i] != -1:
+                        trait_accum[chain, i, trait_known[i]] += 1
+
+    return gene_accum, trait_accum
+
+
+@functools.cache
+def compiled_gibbs_kernel():
+    """
+    Return `_gibbs_kernel` compiled with Numba.
+    """
+    return import_numba().njit(parallel=True, cache=True)(_gibbs_kernel)
+
+
+def numba_installed():
+    """
+    Return whether Numba is installed, without importing it.
+    """
+    return importlib.util.find_spec("numba") is not None
+
+
+def import_numba():
+    """
+    Import Numba into this module's globals, where the kernels refer to
+    it, and return it.
+    """
+    global numba
+    import numba
+    return numba
 
 
 def load_data(filename):
@@ -119,185 +772,197 @@ def load_data(filename):
     return data
 
 
-def powerset(s):
+def index_people(people):
     """
-    Return a list of all possible subsets of set s.
+    Encode `people` as parallel arrays indexed by position in the CSV.
+    Return the list of names along with `mother_idx` and `father_idx`
+    (int32, -1 for no parent) and `trait_known` (int8: -1 unknown, 0, 1).
     """
-    s = list(s)
-    return [
-        set(s) for s in itertools.chain.from_iterable(
-            itertools.combinations(s, r) for r in range(len(s) + 1)
-        )
-    ]
+    order = list(people)
+    name_to_idx = {name: i for i, name in enumerate(order)}
+
+    mother_idx = np.asarray(
+        [name_to_idx.get(people[name]["mother"], -1) for name in order],
+        dtype=np.int32
+    )
+    father_idx = np.asarray(
+        [name_to_idx.get(people[name]["father"], -1) for name in order],
+        dtype=np.int32
+    )
+    trait_known = np.asarray(
+        [-1 if people[name]["trait"] is None else int(people[name]["trait"])
+         for name in order],
+        dtype=np.int8
+    )
+    return order, mother_idx, father_idx, trait_known
+
+
+def powerset_bits(n):
+    """
+    Return all possible subsets of n people, each encoded as a bitmask
+    where bit i is set iff person i is in the subset.
+    """
+    return range(1 << n)
 
 
-def joint_probability(people, one_gene, two_genes, have_trait):
+def submasks(mask):
     """
-    Compute and return a joint probability.
-
-    The probability returned should be the probability that
-        * everyone in set `one_gene` has one copy of the gene, and
-        * everyone in set `two_genes` has two copies of the gene, and
-        * everyone not in `one_gene` or `two_gene` does not have the gene, and
-        * everyone in set `have_trait` has the trait, and
-        * everyone not in set` have_trait` does not have the trait.
+    Yield every subset of the set encoded by bitmask `mask`, as a bitmask,
+    largest first. Each step is a single integer update; no sets are built.
     """
+    sub = mask
+    while True:
+        yield sub
+        if sub == 0:
+            return
+        sub = (sub - 1) & mask
 
-    joint_probabilities = []
-
-    # Define the gene probabilities for people with no parents
-    def no_parent_probability(person, genes):
-        return PROBS["gene"][genes]
 
-    # Define the gene probability for people with parents 
-    def gene_probability_parents(person, genes):
+def config_grids(trait_known, start=0, stop=None):
+    """
+    Return `gene_grid` of shape (M_gene, N) holding every assignment of
+    gene counts to people, or rows `start` to `stop` of it, and
+    `trait_grid` of shape (M_trait, N) holding every assignment of traits
+    consistent with `trait_known`.
+    """
+    n = len(trait_known)
+    if stop is None:
+        stop = 3 ** n
+
+    # Row r gives person i the i-th base-3 digit of r as their gene count,
+    # filled one column at a time to keep temporaries to one column
+    rest = np.arange(start, stop, dtype=np.int64)
+    gene_grid = np.empty((len(rest), n), dtype=np.int8)
+    for i in range(n):
+        gene_grid[:, i] = rest % 3
+        rest //= 3
+
+    # Fix known traits, and give the rest every combination of bits
+    free = np.flatnonzero(trait_known == -1)
+    trait_grid = np.repeat(np.maximum(trait_known, 0)[None, :], 2 ** len(free), axis=0)
+    trait_grid[:, free] = np.arange(2 ** len(free))[:, None] >> np.arange(len(free)) & 1
+    return gene_grid, trait_grid
+
+
+def log_gene_factor_table(mother_idx):
+    """
+    Return a (N, 3, 3, 3) array whose entry
+    [person, genes, mother_genes, father_genes] is the log-probability of
+    that person's gene count given their parents' gene counts.
+    """
+    return np.where(
+        (mother_idx == -1)[:, None, None, None],
+        LOG_GENE_PRIOR[:, None, None],
+        LOG_PARENT_TABLE
+    )
 
-        # Variables
-        mother = people[person]["mother"]
-        father = people[person]["father"]
-        mother_probability = 0
-        father_probability = 0
 
-        # Probabilities for each parent
-        if mother in one_gene:
-            mother_probability = 0.5 
-   
-        elif mother in two_genes:
-            mother_probability = 1 - PROBS["mutation"]
+def batch_joint_log_probabilities(mother_idx, father_idx, trait_known, start=0, stop=None):
+    """
+    Compute the log joint probability of every configuration consistent
+    with the known traits, or of those in rows `start` to `stop` of
+    `gene_grid` (see `config_grids`).
 
-        else:
-            mother_probability = PROBS["mutation"]
+    Return `gene_grid` of shape (M_gene, N) and `trait_grid` of shape
+    (M_trait, N), holding each person's gene count and trait per row,
+    and `logp_all` of shape (M_gene, M_trait) with the log probabilities.
+    """
+    n = len(mother_idx)
+    gene_grid, trait_grid = config_grids(trait_known, start, stop)
 
-        if father in one_gene:
-            father_probability = 0.5 
-            
-        elif father in two_genes:
-            father_probability = 1 - PROBS["mutation"]
+    # Gene term of every gene row, from each person's factor.
+    # A parentless person's mother and father index of -1 picks an
+    # arbitrary column, which their factor doesn't depend on anyway.
+    factor = log_gene_factor_table(mother_idx)
+    gene_logp = np.zeros(len(gene_grid))
+    for i in range(n):
+        gene_logp += factor[i][
+            gene_grid[:, i], gene_grid[:, mother_idx[i]], gene_grid[:, father_idx[i]]
+        ]
 
-        else:
-            father_probability = PROBS["mutation"]
+    # Trait term of every pair of rows. Both terms are added one person
+    # at a time so that no temporary has a person axis as well
+    logp_all = np.repeat(gene_logp[:, None], len(trait_grid), axis=1)
+    for i in range(n):
+        logp_all += LOG_TRAIT_PROBS[gene_grid[:, i, None], trait_grid[None, :, i]]
 
+    return gene_grid, trait_grid, logp_all
 
-        # Probability of 0 copies of the gene
-        if genes == 0:
-            return ((1 - mother_probability) * (1 - father_probability))
 
-        # Probability of 1 copy of the gene
-        elif genes == 1:
-            return ((1 - mother_probability) * father_probability) + (mother_probability * (1 - father_probability))
+def gene_joint_probability(mothers, fathers, one_gene, two_genes):
+    """
+    Compute and return the probability that everyone has the number of
+    copies of the gene given by `one_gene` and `two_genes`, regardless
+    of traits.
+
+    People are referred to by index; `mothers` and `fathers` are tuples
+    holding each person's parent index (-1 for no parent), and `one_gene`
+    and `two_genes` are bitmasks where bit i is set iff person i is in
+    the set.
+    """
 
-        # Probability of 2 copies of the gene
-        elif genes == 2:
-            return (mother_probability * father_probability)
+    # Number of copies of the gene person i has in this configuration
+    def gene_count(i):
+        return ((one_gene >> i) & 1) + 2 * ((two_genes >> i) & 1)
 
-   
-    def get_trait_probability(person, genes):
+    # Sum log-probabilities over all people
+    logp = 0.0
+    for person, (mother, father) in enumerate(zip(mothers, fathers)):
 
-        # People with trait
-        if person in have_trait:
-            return PROBS["trait"][genes][True]
+        if mother == -1:
+            logp += LOG_GENE_PRIOR[gene_count(person)]
 
         else:
-            return PROBS["trait"][genes][False]
-
-    # Iterate over all people
-    for person in people:
-
-        gene_probability = 0
-        trait_probability = 0
-        
-        # Check how many genes to test for
-        if person in one_gene:
-            if not people[person]["mother"]:
-                gene_probability = no_parent_probability(person, 1)
+            logp += LOG_PARENT_TABLE[gene_count(person), gene_count(mother), gene_count(father)]
 
-            else:
-                gene_probability = gene_probability_parents(person, 1)
-            trait_probability = get_trait_probability(person, 1)
+        # Stop at the first impossible gene count, e.g. with no mutation
+        if logp == -math.inf:
+            return 0.0
 
-        elif person in two_genes:
-            if not people[person]["mother"]:
-                gene_probability = no_parent_probability(person, 2)
+    return math.exp(logp)
 
-            else:
-                gene_probability = gene_probability_parents(person, 2)
-            trait_probability = get_trait_probability(person, 2)
 
-        # Probability of person having 0 genes
-        else:
-            if not people[person]["mother"]:
-                gene_probability = no_parent_probability(person, 0)
-
-            else:
-                gene_probability = gene_probability_parents(person, 0)
-            trait_probability = get_trait_probability(person, 0)
-            
-        final_individual_probability = gene_probability * trait_probability
-
-        joint_probabilities.append(final_individual_probability)
+def trait_joint_probability(n, one_gene, two_genes, have_trait):
+    """
+    Compute and return the probability that exactly the people in
+    `have_trait` have the trait, given that each of the n people has the
+    number of copies of the gene given by `one_gene` and `two_genes`.
+    """
+    logp = 0.0
+    for person in range(n):
+        genes = ((one_gene >> person) & 1) + 2 * ((two_genes >> person) & 1)
+        logp += LOG_TRAIT_PROBS[genes, (have_trait >> person) & 1]
 
-    return math.prod(joint_probabilities)
+    return math.exp(logp)
 
 
-def update(probabilities, one_gene, two_genes, have_trait, p):
+def update(gene_accum, trait_accum, one_gene, two_genes, have_trait, p):
     """
-    Add to `probabilities` a new joint probability `p`.
+    Add to `gene_accum` and `trait_accum` a new joint probability `p`.
     Each person should have their "gene" and "trait" distributions updated.
     Which value for each distribution is updated depends on whether
     the person is in `have_gene` and `have_trait`, respectively.
     """
 
-    for person in probabilities:
+    for person in range(len(gene_accum)):
 
         # Add gene probility
-        genes = 0
-
-        if person in one_gene:
-            genes = 1
-
-        elif person in two_genes:
-            genes = 2
-
-        probabilities[person]["gene"][genes] = probabilities[person]["gene"][genes] + p
+        genes = ((one_gene >> person) & 1) + 2 * ((two_genes >> person) & 1)
+        gene_accum[person, genes] += p
 
         # Add trait probability
-        trait = False
-
-        if person in have_trait:
-            trait = True
+        trait = (have_trait >> person) & 1
+        trait_accum[person, trait] += p
 
-        probabilities[person]["trait"][trait] = probabilities[person]["trait"][trait] + p
 
-
-def normalize(probabilities):
+def normalize(gene_accum, trait_accum):
     """
-    Update `probabilities` such that each probability distribution
-    is normalized (i.e., sums to 1, with relative proportions the same).
+    Update `gene_accum` and `trait_accum` such that each person's
+    distribution (each row) is normalized (i.e., sums to 1, with relative
+    proportions the same).
     """
-
-    for person in probabilities:
-
-        # Normalize gene
-        gene_2 = probabilities[person]["gene"][2]
-        gene_1 = probabilities[person]["gene"][1]
-        gene_0 = probabilities[person]["gene"][0]
-
-        gene_normalizer = 1 / (gene_0 + gene_1 + gene_2)
-
-        # Update genes
-        probabilities[person]["gene"][2] = gene_2 * gene_normalizer
-        probabilities[person]["gene"][1] = gene_1 * gene_normalizer
-        probabilities[person]["gene"][0] = gene_0 * gene_normalizer
-
-        # Normalize trait
-        true_trait = probabilities[person]["trait"][True]
-        false_trait = probabilities[person]["trait"][False]
-
-        trait_normalizer = 1 / (true_trait + false_trait)
-
-        # Update traits
-        probabilities[person]["trait"][True] = true_trait * trait_normalizer
-        probabilities[person]["trait"][False] = false_trait * trait_normalizer
+    gene_accum /= gene_accum.sum(axis=1, keepdims=True)
+    trait_accum /= trait_accum.sum(axis=1, keepdims=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+import sys
+
+from Cython.Build import cythonize
+from setuptools import Extension, setup
+
+# Only tune the kernel for this CPU when building it in place, to run
+# here; wheels and installs may be copied to other machines
+compile_args = ["-O3", "-fopenmp"]
+if "--inplace" in sys.argv:
+    compile_args.append("-march=native")
+
+extensions = cythonize(
+    Extension(
+        "_heredity",
+        ["_heredity.pyx"],
+        extra_compile_args=compile_args,
+        extra_link_args=["-fopenmp"]
+    ),
+    language_level=3,
+    annotate=True
+)
+
+# heredity.py runs without the kernel, so install without it if it can't
+# be built, e.g. by a compiler without OpenMP. Set here because cythonize
+# doesn't copy `optional` to the extensions it returns
+for extension in extensions:
+    extension.optional = True
+
+setup(
+    py_modules=["heredity"],
+    ext_modules=extensions
+)
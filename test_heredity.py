@@ -0,0 +1,400 @@
+import contextlib
+import importlib
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+import types
+import unittest
+import warnings
+from unittest import mock
+
+import numpy as np
+
+import heredity
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+FAMILIES = sorted(
+    os.path.join(DATA, filename) for filename in os.listdir(DATA)
+    if filename.endswith(".csv")
+)
+
+
+def normalized(gene_accum, trait_accum):
+    """
+    Return normalized copies of `gene_accum` and `trait_accum`.
+    """
+    gene_accum, trait_accum = gene_accum.copy(), trait_accum.copy()
+    heredity.normalize(gene_accum, trait_accum)
+    return gene_accum, trait_accum
+
+
+def enter_context(test, context):
+    """
+    Enter `context` until `test` ends and return its value, as
+    `TestCase.enterContext` does from Python 3.11.
+    """
+    value = context.__enter__()
+    test.addCleanup(context.__exit__, None, None, None)
+    return value
+
+
+def write_family(directory, n):
+    """
+    Write a CSV of `n` people to `directory` and return its path. The first
+    two have no parents, and everyone else is the child of the two before
+    them; every third person's trait is unknown.
+    """
+    filename = os.path.join(directory, f"family{n}.csv")
+    with open(filename, "w") as f:
+        f.write("name,mother,father,trait\n")
+        for i in range(n):
+            parents = ("", "") if i < 2 else (f"p{i - 2}", f"p{i - 1}")
+            trait = "" if i % 3 == 0 else str(i % 2)
+            f.write(f"p{i},{parents[0]},{parents[1]},{trait}\n")
+    return filename
+
+
+def zero_mutation_tables():
+    """
+    Return patches replacing the probability tables with those for a
+    mutation probability of 0, under which a child's gene count can be
+    impossible given their parents'.
+    """
+    transmission = np.array([0.0, 0.5, 1.0])
+    parent_table = np.stack([
+        np.outer(1 - transmission, 1 - transmission),
+        np.outer(transmission, 1 - transmission) + np.outer(1 - transmission, transmission),
+        np.outer(transmission, transmission)
+    ])
+    with np.errstate(divide="ignore"):
+        log_parent_table = np.log(parent_table)
+    stack = contextlib.ExitStack()
+    stack.enter_context(mock.patch.object(heredity, "PARENT_TABLE", parent_table))
+    stack.enter_context(mock.patch.object(heredity, "LOG_PARENT_TABLE", log_parent_table))
+    return stack
+
+
+class BackendTest(unittest.TestCase):
+    """
+    Check that every available backend agrees with `loop_probabilities`
+    on the bundled families.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.families = [
+            heredity.index_people(heredity.load_data(filename))[1:]
+            for filename in FAMILIES
+        ]
+        cls.expected = [
+            normalized(*heredity.loop_probabilities(*family))
+            for family in cls.families
+        ]
+
+    def check(self, backend, atol=1e-12):
+        for filename, family, expected in zip(FAMILIES, self.families, self.expected):
+            with self.subTest(family=os.path.basename(filename)):
+                gene_accum, trait_accum = normalized(*backend(*family))
+                np.testing.assert_allclose(gene_accum, expected[0], atol=atol)
+                np.testing.assert_allclose(trait_accum, expected[1], atol=atol)
+
+    def test_batch(self):
+        self.check(heredity.batch_probabilities)
+
+    def test_batch_in_slices(self):
+
+        # A few gene rows at a time, as for families too large for one pass
+        with mock.patch.object(heredity, "MAX_BATCH_BYTES", 2 ** 10):
+            self.check(heredity.batch_probabilities)
+
+    def test_enum(self):
+        self.check(heredity.enum_probabilities)
+
+    def test_enum_without_kernels(self):
+
+        # Only the reference loop would be left, which is far too slow
+        with mock.patch.object(heredity, "MAX_BATCH_BYTES", 1), \
+                mock.patch.object(heredity, "numba_installed", return_value=False), \
+                mock.patch.object(heredity, "_heredity", None), \
+                mock.patch.object(heredity, "loop_probabilities") as loop, \
+                self.assertRaisesRegex(ValueError, "requires Numba"):
+            heredity.enum_probabilities(*self.families[0])
+        loop.assert_not_called()
+
+    @unittest.skipUnless(importlib.util.find_spec("jax"), "JAX is not installed")
+    def test_jax(self):
+        self.check(heredity.jax_probabilities)
+
+    @unittest.skipUnless(heredity.numba_installed(), "Numba is not installed")
+    def test_numba(self):
+        self.check(heredity.kernel_probabilities)
+
+    @unittest.skipUnless(heredity._heredity is not None, "the Cython kernel is not built")
+    def test_cython(self):
+        self.check(heredity.cython_probabilities)
+
+    @unittest.skipUnless(heredity.numba_installed(), "Numba is not installed")
+    def test_gibbs(self):
+
+        # Sampling only estimates the probabilities
+        self.check(lambda *family: heredity.gibbs_estimates(*family)[:2], atol=0.01)
+
+
+class ZeroMutationTest(unittest.TestCase):
+    """
+    Check that impossible gene configurations, whose log-probability is
+    -inf, contribute nothing when the mutation probability is 0.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.family = heredity.index_people(heredity.load_data(FAMILIES[-1]))[1:]
+        with zero_mutation_tables():
+            cls.expected = normalized(*heredity.batch_probabilities(*cls.family))
+
+    def setUp(self):
+        enter_context(self, zero_mutation_tables())
+
+    def check(self, backend):
+        gene_accum, trait_accum = normalized(*backend(*self.family))
+        np.testing.assert_allclose(gene_accum, self.expected[0], atol=1e-12)
+        np.testing.assert_allclose(trait_accum, self.expected[1], atol=1e-12)
+
+    def test_impossible_genes(self):
+
+        # Two parents without the gene can't have a child with it
+        mothers, fathers = (-1, -1, 0), (-1, -1, 1)
+        self.assertEqual(heredity.gene_joint_probability(mothers, fathers, 0b100, 0), 0.0)
+        self.assertTrue(np.isfinite(self.expected[0]).all())
+        self.assertTrue(np.isfinite(self.expected[1]).all())
+
+    def test_batch_in_slices(self):
+
+        # Some slices then hold only impossible configurations
+        with mock.patch.object(heredity, "MAX_BATCH_BYTES", 2 ** 10):
+            self.check(heredity.batch_probabilities)
+
+    @unittest.skipUnless(heredity.numba_installed(), "Numba is not installed")
+    def test_numba(self):
+        self.check(heredity.kernel_probabilities)
+
+    @unittest.skipUnless(heredity._heredity is not None, "the Cython kernel is not built")
+    def test_cython(self):
+        self.check(heredity.cython_probabilities)
+
+    def test_gibbs(self):
+        with self.assertRaises(ValueError):
+            heredity.gibbs(*self.family, heredity.GIBBS_ITERATIONS)
+
+
+class MainTest(unittest.TestCase):
+    """
+    Check how `main` parses its arguments and picks a method, with the
+    methods themselves replaced by stubs.
+    """
+
+    def setUp(self):
+        directory = enter_context(self, tempfile.TemporaryDirectory())
+        self.large = write_family(directory, heredity.ENUM_MAX_PEOPLE + 1)
+        self.larger = write_family(directory, heredity.CYTHON_ENUM_MAX_PEOPLE + 1)
+        self.too_large = write_family(directory, heredity.ENUM_LIMIT_PEOPLE + 1)
+
+        def stub(mother_idx, *args):
+            return np.ones((len(mother_idx), 3)), np.ones((len(mother_idx), 2))
+        self.enum = enter_context(
+            self, mock.patch.object(heredity, "enum_probabilities", side_effect=stub)
+        )
+
+        # Every chain agrees unless `self.chain_spread` is set
+        self.chain_spread = 0.0
+
+        def gibbs_stub(mother_idx, *args):
+            chains = np.ones((heredity.GIBBS_CHAINS, len(mother_idx), 3))
+            chains[0, :, 0] += self.chain_spread
+            return chains, np.ones((heredity.GIBBS_CHAINS, len(mother_idx), 2))
+        self.gibbs = enter_context(
+            self, mock.patch.object(heredity, "gibbs", side_effect=gibbs_stub)
+        )
+
+    def run_main(self, *args, numba=True, cython=True):
+        """
+        Run `main` with command-line arguments `args`, as if Numba and the
+        Cython kernel were installed or not, and return what it prints.
+        """
+        output = io.StringIO()
+        with mock.patch.object(sys, "argv", ["heredity.py", *args]), \
+                mock.patch.object(heredity, "numba_installed", return_value=numba), \
+                mock.patch.object(heredity, "_heredity", object() if cython else None), \
+                contextlib.redirect_stdout(output):
+            heredity.main()
+        return output.getvalue()
+
+    def test_usage(self):
+        for args in [(), (FAMILIES[0], "--method=exact"), (FAMILIES[0], "enum"),
+                     (FAMILIES[0], "--method=enum", "extra")]:
+            with self.subTest(args=args), self.assertRaises(SystemExit) as exit:
+                self.run_main(*args)
+            self.assertTrue(exit.exception.code.startswith("Usage:"))
+
+    def test_output(self):
+        output = self.run_main(FAMILIES[0])
+        self.assertTrue(output.startswith("Harry:\n  Gene:\n    2: 0.3333\n"))
+
+    def test_small_family(self):
+        self.run_main(FAMILIES[0], numba=False, cython=False)
+        self.enum.assert_called_once()
+        self.gibbs.assert_not_called()
+
+    def test_large_family(self):
+        self.run_main(self.large, cython=False)
+        self.gibbs.assert_called_once()
+        self.enum.assert_not_called()
+
+    def test_large_family_cython(self):
+
+        # Enumerated with Cython, whether or not Gibbs sampling is available
+        for numba in (True, False):
+            with self.subTest(numba=numba):
+                self.run_main(self.large, numba=numba)
+                self.enum.assert_called_once()
+                self.gibbs.assert_not_called()
+                self.enum.reset_mock()
+        self.run_main(self.larger)
+        self.gibbs.assert_called_once()
+
+    def test_gibbs_output(self):
+        error = io.StringIO()
+        with contextlib.redirect_stderr(error):
+            output = self.run_main(FAMILIES[0], "--method=gibbs")
+        self.assertTrue(output.startswith("Estimated with Gibbs sampling"))
+        self.assertIn("    2: 0.3333 [0.3333, 0.3333]\n", output)
+        self.assertEqual(error.getvalue(), "")
+
+    def test_empty_family(self):
+        directory = enter_context(self, tempfile.TemporaryDirectory())
+        empty = write_family(directory, 0)
+        self.assertEqual(self.run_main(empty, "--method=enum"), "")
+
+        # Only the line saying the results are estimates
+        self.assertEqual(self.run_main(empty, "--method=gibbs").count("\n"), 1)
+
+    def test_gibbs_chains_disagree(self):
+        self.chain_spread = 10.0
+        error = io.StringIO()
+        with contextlib.redirect_stderr(error):
+            self.run_main(FAMILIES[0], "--method=gibbs")
+        self.assertIn("chains disagree", error.getvalue())
+
+    def test_methods(self):
+        self.run_main(self.large, "--method=enum")
+        self.enum.assert_called_once()
+        self.run_main(FAMILIES[0], "--method=gibbs")
+        self.gibbs.assert_called_once()
+
+    def test_too_large_to_enumerate(self):
+        with self.assertRaises(SystemExit) as exit:
+            self.run_main(self.too_large, "--method=enum")
+        self.assertIn(f"more than {heredity.ENUM_LIMIT_PEOPLE} people", exit.exception.code)
+        self.enum.assert_not_called()
+
+    def test_enum_requires_kernel(self):
+        self.enum.side_effect = ValueError("Enumerating this family requires Numba")
+        with self.assertRaises(SystemExit) as exit:
+            self.run_main(FAMILIES[0], "--method=enum")
+        self.assertIn("requires Numba", exit.exception.code)
+
+    def test_gibbs_requires_numba(self):
+        for args in [(self.large,), (FAMILIES[0], "--method=gibbs")]:
+            with self.subTest(args=args), self.assertRaises(SystemExit) as exit:
+                self.run_main(*args, numba=False, cython=False)
+            self.assertIn("requires Numba", exit.exception.code)
+        self.gibbs.assert_not_called()
+
+    def test_gibbs_requires_mutation(self):
+        with zero_mutation_tables(), self.assertRaises(SystemExit) as exit:
+            self.run_main(self.large, cython=False)
+        self.assertIn("--method=enum", exit.exception.code)
+        self.gibbs.assert_not_called()
+
+
+@unittest.skipUnless(heredity.numba_installed(), "Numba is not installed")
+class GibbsModeTest(unittest.TestCase):
+    """
+    Check that Gibbs chains disagree beyond GIBBS_TOLERANCE on a family
+    whose probabilities have two modes that single-site updates can't move
+    between: unaffected parents of many affected children, one of whom has
+    two copies of the gene and the other none. A family with one mode
+    shouldn't be flagged.
+    """
+
+    def test_modes(self):
+        n_children = 12
+        mother_idx = np.array([-1, -1] + [0] * n_children, dtype=np.int32)
+        father_idx = np.array([-1, -1] + [1] * n_children, dtype=np.int32)
+        trait_known = np.array([0, 0] + [1] * n_children, dtype=np.int8)
+        error = heredity.gibbs_estimates(mother_idx, father_idx, trait_known)[3]
+        self.assertGreater(error, heredity.GIBBS_TOLERANCE)
+
+    def test_one_mode(self):
+
+        # A long chain of parents and children, as in the larger families
+        # Gibbs sampling is used for, has one mode and shouldn't be flagged
+        directory = enter_context(self, tempfile.TemporaryDirectory())
+        family = heredity.index_people(heredity.load_data(write_family(directory, 12)))[1:]
+        error = heredity.gibbs_estimates(*family)[3]
+        self.assertLess(error, heredity.GIBBS_TOLERANCE)
+
+
+class JaxImportTest(unittest.TestCase):
+    """
+    Check that JAX isn't imported to enumerate a family on a host without
+    a GPU plugin for it.
+    """
+
+    def test_no_gpu(self):
+        directory = enter_context(self, tempfile.TemporaryDirectory())
+        family = heredity.index_people(
+            heredity.load_data(write_family(directory, heredity.JAX_MIN_PEOPLE))
+        )[1:]
+
+        # Unload JAX until the test ends, in case another test imported it
+        with mock.patch.dict(sys.modules), \
+                mock.patch.object(heredity, "JAX_GPU_PLUGIN_PREFIXES", ("no_such_plugin",)):
+            for name in [name for name in sys.modules if name.split(".")[0] == "jax"]:
+                del sys.modules[name]
+            heredity.enum_probabilities(*family)
+            self.assertNotIn("jax", sys.modules)
+
+
+class KernelVersionTest(unittest.TestCase):
+    """
+    Check that a Cython extension built from an older _heredity.pyx is
+    ignored, with a warning to rebuild it.
+    """
+
+    def tearDown(self):
+        importlib.reload(heredity)
+
+    def load(self, kernel_version):
+        extension = types.ModuleType("_heredity")
+        extension.KERNEL_VERSION = kernel_version
+        with mock.patch.dict(sys.modules, {"_heredity": extension}):
+            importlib.reload(heredity)
+        return extension
+
+    def test_current(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            extension = self.load(heredity.HEREDITY_KERNEL_VERSION)
+        self.assertIs(heredity._heredity, extension)
+
+    def test_stale(self):
+        with self.assertWarnsRegex(UserWarning, "build_ext --inplace"):
+            self.load(heredity.HEREDITY_KERNEL_VERSION - 1)
+        self.assertIsNone(heredity._heredity)
+
+
+if __name__ == "__main__":
+    unittest.main()